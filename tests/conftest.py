@@ -1,9 +1,10 @@
 from collections import defaultdict
+from collections.abc import Mapping
 from contextlib import contextmanager
+import copy
 import io
 import os
 import stat
-from unittest.mock import MagicMock
 
 import pytest
 
@@ -60,6 +61,17 @@ FROM:    {GCN_FROM}
 {GCN_BODY}\
 """
 
+_CIRCULAR_MSG = {
+    "header": {
+        "title": GCN_TITLE,
+        "number": GCN_NUMBER,
+        "subject": GCN_SUBJECT,
+        "date": GCN_DATE,
+        "from": GCN_FROM,
+    },
+    "body": GCN_BODY,
+}
+
 VOEVENT_XML = """\
 <?xml version='1.0' encoding='UTF-8'?>
 <voe:VOEvent xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" xsi:schemaLocation="http://www.ivoa.net/xml/VOEvent/v2.0 http://www.ivoa.net/xml/VOEvent/VOEvent-v2.0.xsd" version="2.0" role="observation" ivorn="ivo://gwnet/LVC#S200302c-1-Preliminary">
@@ -166,6 +178,8 @@ VOEVENT_XML = """\
 </voe:VOEvent>\
 """
 
+VOEVENT_XML_BYTES = VOEVENT_XML.encode("ascii")
+
 MESSAGE_BLOB = "This is a sample blob message. It is unstructured and does not require special parsing."
 
 # This was the original configuration structure, which permitted only a single credential
@@ -183,6 +197,35 @@ auth = [{
          }]
 """
 
+# pre-encoded forms of the configs above, for writing directly to config files
+AUTH_CONFIG_LEGACY_BYTES = AUTH_CONFIG_LEGACY.encode("ascii")
+AUTH_CONFIG_BYTES = AUTH_CONFIG.encode("ascii")
+
+# Generalize model_name, expected_model, test_file, and model_text
+# for easy access during tests. Useful when combined with parametrization
+# across message format, since fixtures (e.g., GCN_CIRCULAR) cannot be
+# used as parametrize arguments.
+_MESSAGE_PARAMETERS = {
+    "circular": {
+        "model_name": "GCNCircular",
+        "expected_model": models.GCNCircular,
+        "test_file": "example_gcn.gcn3",
+        "model_text": GCN_CIRCULAR,
+    },
+    "voevent": {
+        "model_name": "VOEvent",
+        "expected_model": models.VOEvent,
+        "test_file": "example_voevent.xml",
+        "model_text": VOEVENT_XML_BYTES,
+    },
+    "blob": {
+        "model_name": "Blob",
+        "expected_model": str,
+        "test_file": "example_blob.txt",
+        "model_text": MESSAGE_BLOB,
+    },
+}
+
 
 class MockBroker:
     """Mock a Kafka broker.
@@ -196,37 +239,127 @@ class MockBroker:
         self.reset()
 
     def reset(self):
-        self._messages = defaultdict(list)
-        self._offsets = defaultdict(dict)
-
-    def write(self, topic, msg, headers=[]):
-        self._messages[topic].append((msg, headers))
-
-    def has_message(self, topic, message, headers=[]):
-        return (message, headers) in self._messages[topic]
+        # message payloads and headers are kept in parallel per-topic lists
+        self._msgs = defaultdict(list)
+        self._hdrs = defaultdict(list)
+        self._index = defaultdict(set)
+        # number of messages per topic which could not be added to the index
+        self._unindexed = defaultdict(int)
+        # consumer group offsets, keyed by (topic, groupid)
+        self._offsets = {}
+
+    @staticmethod
+    def _canonical_headers(headers):
+        """Convert a sequence of header pairs to a tuple of tuples, so lists and tuples compare equal.
+
+        Missing headers (None) are kept as None, so they remain distinct from an empty sequence.
+
+        """
+        if headers is None or isinstance(headers, Mapping):
+            return headers
+        return tuple(tuple(header) for header in headers)
+
+    @classmethod
+    def _index_key(cls, msg, headers):
+        """Build a hashable key for a message, or None if it cannot be indexed."""
+        if isinstance(headers, Mapping):
+            return None
+        try:
+            key = (msg, cls._canonical_headers(headers))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def write(self, topic, msg, headers=()):
+        self._msgs[topic].append(msg)
+        self._hdrs[topic].append(headers)
+        key = self._index_key(msg, headers)
+        if key is not None:
+            self._index[topic].add(key)
+        else:
+            self._unindexed[topic] += 1
+
+    def has_message(self, topic, message, headers=()):
+        key = self._index_key(message, headers)
+        if key is not None and key in self._index[topic]:
+            return True
+        # an equal message may still be among those which could not be indexed
+        if key is not None and not self._unindexed[topic]:
+            return False
+        headers = self._canonical_headers(headers)
+        return any(
+            m == message and self._canonical_headers(h) == headers
+            for m, h in zip(self._msgs[topic], self._hdrs[topic])
+        )
 
     def read(self, topics, groupid, start_at=StartPosition.EARLIEST, **kwargs):
         if isinstance(topics, str):
             topics = [topics]
 
         for topic in topics:
-            if topic not in self._offsets or groupid not in self._offsets[topic]:
-                if start_at == StartPosition.EARLIEST:
-                    self._offsets[topic][groupid] = 0
-                else:
-                    self._offsets[topic][groupid] = len(self._messages[topic]) - 1
-
-            try:
-                offset = self._offsets[topic][groupid]
-                self._offsets[topic][groupid] += 1
-                yield from self._messages[topic][offset:]
-            except IndexError:
-                pass
+            key = (topic, groupid)
+            msgs = self._msgs[topic]
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = 0 if start_at == StartPosition.EARLIEST else len(msgs) - 1
+            end = len(msgs)
+            if offset < end:
+                self._offsets[key] = end
+                # index directly rather than slicing, to avoid copying the backlog on every read
+                hdrs = self._hdrs[topic]
+                for i in range(max(offset, 0), end):
+                    yield msgs[i], hdrs[i]
 
 
-@pytest.fixture(scope="session")
+class FakeKafkaMessage:
+    """Stand-in for a confluent_kafka.Message with fixed metadata."""
+
+    _headers = [("a header", "a value"), ("another header", "other value")]
+
+    def topic(self):
+        return "test-topic"
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return 0
+
+    def timestamp(self):
+        return (0, 1234567890)
+
+    def key(self):
+        return "test-key"
+
+    def headers(self):
+        return self._headers
+
+
+_FAKE_KAFKA_MESSAGE = FakeKafkaMessage()
+
+
+class MockMessage:
+    """A message as yielded by the mock consumer's stream."""
+
+    __slots__ = ("_value", "_headers")
+
+    def __init__(self, value, headers=()):
+        self._value = value
+        self._headers = headers
+
+    def value(self):
+        return self._value
+
+    def headers(self):
+        return self._headers
+
+
+@pytest.fixture
 def mock_broker():
-    return MockBroker()
+    broker = MockBroker()
+    yield broker
+    broker.reset()
 
 
 @pytest.fixture(scope="session")
@@ -237,7 +370,7 @@ def mock_producer():
                 self.broker = broker
                 self.topic = topic
 
-            def write(self, msg, headers=[], delivery_callback=None):
+            def write(self, msg, headers=(), delivery_callback=None):
                 self.broker.write(self.topic, msg, headers)
 
             def close(self):
@@ -264,27 +397,17 @@ def mock_consumer():
                     topics = [topics]
                 self.broker = broker
                 self.topics = topics
+                self._topic_set = frozenset(topics)
                 self.group_id = group_id
                 self.start_at = start_at
 
             def subscribe(self, topics):
                 for topic in topics:
-                    assert topic in set(self.topics)
+                    assert topic in self._topic_set
 
             def stream(self, *args, **kwargs):
-                class Message:
-                    def __init__(self, value, headers=[]):
-                        self._value = value
-                        self._headers = headers
-
-                    def value(self):
-                        return self._value
-
-                    def headers(self):
-                        return self._headers
-
-                for message in self.broker.read(self.topics, self.group_id, self.start_at, **kwargs):
-                    yield Message(message[0], message[1])
+                for value, headers in self.broker.read(self.topics, self.group_id, self.start_at, **kwargs):
+                    yield MockMessage(value, headers)
 
             def close(self):
                 pass
@@ -303,24 +426,17 @@ def mock_consumer():
 
 @pytest.fixture(scope="session")
 def mock_kafka_message():
-    message = MagicMock()
-    message.topic.return_value = "test-topic"
-    message.partition.return_value = 0
-    message.offset.return_value = 0
-    message.timestamp.return_value = (0, 1234567890)
-    message.key.return_value = "test-key"
-    message.headers.return_value = [("a header", "a value"), ("another header", "other value")]
-    return message
+    return _FAKE_KAFKA_MESSAGE
 
 
 @pytest.fixture(scope="session")
 def legacy_auth_config():
-    return AUTH_CONFIG_LEGACY
+    return AUTH_CONFIG_LEGACY_BYTES
 
 
 @pytest.fixture(scope="session")
 def auth_config():
-    return AUTH_CONFIG
+    return AUTH_CONFIG_BYTES
 
 
 @pytest.fixture(scope="session")
@@ -328,23 +444,22 @@ def circular_text():
     return GCN_CIRCULAR
 
 
-@pytest.fixture(scope="session")
+@pytest.fixture
 def circular_msg():
-    return {
-        "header": {
-            "title": GCN_TITLE,
-            "number": GCN_NUMBER,
-            "subject": GCN_SUBJECT,
-            "date": GCN_DATE,
-            "from": GCN_FROM,
-        },
-        "body": GCN_BODY,
-    }
+    # hand out a copy so tests which mutate the message cannot affect one another
+    return copy.deepcopy(_CIRCULAR_MSG)
 
 
 @pytest.fixture(scope="session")
 def voevent_fileobj():
-    return io.BytesIO(VOEVENT_XML.encode())
+    # share one buffer, rewinding it each time so earlier reads do not leave it at EOF
+    buf = io.BytesIO(VOEVENT_XML_BYTES)
+
+    def _voevent_fileobj():
+        buf.seek(0)
+        return buf
+
+    return _voevent_fileobj
 
 
 @pytest.fixture(scope="session")
@@ -364,30 +479,7 @@ def blob_msg():
 
 @pytest.fixture(scope="session")
 def message_parameters_dict():
-    # Generalize model_name, expected_model, test_file, and model_text
-    # for easy access during tests. Useful when combined with parametrization
-    # across message format, since fixtures (e.g., GCN_CIRCULAR) cannot be
-    # used as parametrize arguments.
-    return {
-        "circular": {
-            "model_name": "GCNCircular",
-            "expected_model": models.GCNCircular,
-            "test_file": "example_gcn.gcn3",
-            "model_text": GCN_CIRCULAR,
-        },
-        "voevent": {
-            "model_name": "VOEvent",
-            "expected_model": models.VOEvent,
-            "test_file": "example_voevent.xml",
-            "model_text": VOEVENT_XML.encode(),
-        },
-        "blob": {
-            "model_name": "Blob",
-            "expected_model": str,
-            "test_file": "example_blob.txt",
-            "model_text": MESSAGE_BLOB,
-        },
-    }
+    return _MESSAGE_PARAMETERS
 
 
 @contextmanager
@@ -418,7 +510,7 @@ def temp_config(tmpdir, data, perms=stat.S_IRUSR | stat.S_IWUSR):
     A context manager which creates a temporary config file with specified data and permissions
 
     Args:
-        data: the data to be written to the file
+        data: the data to be written to the file, as either str or bytes
         perms: the permissions which should be set on the file.
             The default value is to use the standard, safe permissions
 
@@ -428,10 +520,15 @@ def temp_config(tmpdir, data, perms=stat.S_IRUSR | stat.S_IWUSR):
 
     config_path = f"{tmpdir}/hop/auth.toml"
     os.makedirs(os.path.dirname(config_path), exist_ok=True)
-    config_file = open(config_path, mode='w')
-    os.chmod(config_path, perms)
-    config_file.write(data)
-    config_file.close()
+    if isinstance(data, str):
+        data = data.encode()
+    fd = os.open(config_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, perms)
+    try:
+        # the mode passed to open is subject to the umask and ignored for existing files
+        os.fchmod(fd, perms)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
     try:
         yield str(tmpdir)
     finally:
@@ -235,6 +235,16 @@ def test_stream_write_raw(circular_msg, circular_text, mock_broker, mock_produce
         s.close()
         assert mock_broker.has_message(topic, encoded_msg, canonical_headers)
 
+        # without headers, write_raw passes None through to the producer
+        mock_broker.reset()
+        with stream.open(broker_url, "w") as s:
+            s.write_raw(encoded_msg)
+            assert mock_broker._hdrs[topic][0] is None
+            assert mock_broker.has_message(topic, encoded_msg, None)
+            # missing headers are not the same as an empty header list
+            assert not mock_broker.has_message(topic, encoded_msg)
+            assert not mock_broker.has_message(topic, encoded_msg, canonical_headers)
+
 
 def test_stream_auth(auth_config, tmpdir):
     # turning off authentication should give None for the auth property
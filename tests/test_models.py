@@ -13,7 +13,7 @@ def test_MessageModel():
 
 
 def test_voevent(voevent_fileobj):
-    voevent = models.VOEvent.load(voevent_fileobj)
+    voevent = models.VOEvent.load(voevent_fileobj())
 
     # check a few attributes
     assert voevent.ivorn == "ivo://gwnet/LVC#S200302c-1-Preliminary"